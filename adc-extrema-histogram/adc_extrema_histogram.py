@@ -12,6 +12,11 @@ from tqdm import tqdm
 
 import fiftyl_toolkit
 
+try:
+    from fast_histogram import histogram1d
+except ImportError:
+    histogram1d = None
+
 __author__ = "Alejandro Oranday"
 __contact__ = "alejandro@oran.day"
 
@@ -20,11 +25,80 @@ DT_FORMAT = "%Y%m%dT%H%M%S" # datetime format from hdf5 files.
 FIGURE_PATH = "./figures"
 SAVE_PATH = "./saved_arrays"
 
+WINDOW_SIZE = 800 # Limiting total window size for now.
+MIN_WINDOW = 50 # Ticks after the maximum to search for the minimum.
+
+def fast_median(adcs, axis):
+    """
+    Floored median of integer :adcs: along :axis: by partitioning instead of sorting.
+    Matches np.floor(np.median(adcs, axis=axis)) in the dtype of :adcs:.
+    """
+    num = adcs.shape[axis]
+    k = num // 2
+    if num % 2:
+        return np.partition(adcs, k, axis=axis).take(k, axis=axis)
+    part = np.partition(adcs, (k-1, k), axis=axis)
+    low = part.take(k-1, axis=axis).astype(np.int64)
+    return ((low + part.take(k, axis=axis)) // 2).astype(adcs.dtype)
+
 def median_subtraction(adcs):
     """
     Median subtract an ADCs matrix.
+    The 14-bit ADCs fit in int16, so the result is an int16 copy subtracted in place.
+    """
+    wfs = adcs.astype(np.int16)
+    np.subtract(wfs, fast_median(wfs, 0), out=wfs)
+    return wfs
+
+def histogram(values, bins):
+    """
+    Histogram values into uniform width bins.
+        values
+            1D array of values to histogram.
+        bins
+            Uniform width bin edges.
+    Uses fast_histogram when it is available and falls back to np.histogram.
+    Returns the counts for each bin.
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    if histogram1d is None:
+        counts, _ = np.histogram(values, bins=bins)
+        return counts
+    counts = histogram1d(values, bins=len(bins)-1, range=(bins[0], bins[-1]))
+    counts[-1] += np.count_nonzero(values == bins[-1]) # np.histogram includes the last edge.
+    return counts
+
+def extract_channel_batch(data, records, channel):
+    """
+    Extract a single channel from every record and median subtract them together.
+        data
+            fiftyl_toolkit.Data to read from.
+        records
+            Records to extract.
+        channel
+            Channel to extract.
+    Returns
+        2D array of (records, WINDOW_SIZE) waveforms and the number of records skipped for a shape mismatch.
+    """
+    raw_wfs = []
+    mismatch_cnt = 0
+    for record in records:
+        try:
+            wf = data.extract(record, [channel])[:, 0]
+        except ValueError:
+            mismatch_cnt += 1
+            continue
+        if wf.shape[0] < WINDOW_SIZE:
+            mismatch_cnt += 1
+            continue
+        raw_wfs.append(wf)
+
+    if not raw_wfs: # Every record was skipped; keep the empty histograms of before.
+        return np.empty((0, WINDOW_SIZE), dtype=np.int16), mismatch_cnt
+    if len({wf.shape[0] for wf in raw_wfs}) == 1: # Equal lengths are median subtracted as one (time, records) block.
+        wfs = median_subtraction(np.stack(raw_wfs, axis=1)).T
+    else:
+        wfs = np.stack([median_subtraction(wf)[:WINDOW_SIZE] for wf in raw_wfs])
+    return wfs[:, :WINDOW_SIZE], mismatch_cnt
 
 def get_extrema(adcs, ext_operator):
     """
@@ -39,7 +113,23 @@ def get_extrema(adcs, ext_operator):
     return ext_operator(adcs, axis=1)
 
 
-def plot_hist(extrema, dt_title, run_id, ext_str, channel, savetype="svg"):
+def get_window_extrema(wfs):
+    """
+    Get the maximum of each waveform and the minimum shortly after it.
+        wfs
+            2D array of (records, time) waveforms.
+    Returns
+        1D arrays of (records,) with the maxima and the minima within MIN_WINDOW ticks of each maximum.
+    """
+    max_idx = wfs.argmax(axis=1)
+    max_array = np.take_along_axis(wfs, max_idx[:, None], axis=1)[:, 0]
+
+    # Clipping repeats the last tick, which is already inside a truncated window.
+    window = np.minimum(max_idx[:, None] + np.arange(MIN_WINDOW), wfs.shape[1] - 1)
+    min_array = np.take_along_axis(wfs, window, axis=1).min(axis=1)
+    return max_array, min_array
+
+def plot_hist(extrema, dt_title, run_id, ext_str, channel, savetype="svg", figure=None):
     """
     Plot a histogram of extrema values.
         extrema
@@ -54,22 +144,34 @@ def plot_hist(extrema, dt_title, run_id, ext_str, channel, savetype="svg"):
             Integer of which channel this focuses on.
         savetype
             String of the format to save the plot as
+        figure
+            Optional (fig, ax, stairs) from a previous call to draw into instead of a new figure.
+    Returns the (fig, ax, stairs) that was drawn into so it can be reused.
     """
     save_name = f"selective_extrema-{ext_str[:3].lower()}_ch{channel}_hist_{dt_title.strftime(DT_FORMAT)}.{savetype}"
 
     if ext_str.lower()[:3] == "max":
-        bins = range(0,150,5)
+        bins = np.arange(0,150,5)
     elif ext_str.lower()[:3] == "min":
-        bins = range(-150,0,5)
+        bins = np.arange(-150,0,5)
     else:
-        bins = None
+        bins = np.histogram_bin_edges(extrema)
+
+    counts = histogram(extrema, bins)
 
-    plt.figure()
-    plt.hist(extrema, bins=bins, color='k')
-    plt.title(f"Channel {channel} {ext_str} ADC Histogram:\n Run {run_id} {dt_title}")
-    plt.xlabel("ADC Count")
-    plt.ylabel("Count")
-    plt.savefig(os.path.join(FIGURE_PATH, save_name))
+    if figure is None:
+        fig, ax = plt.subplots()
+        stairs = ax.stairs(counts, bins, fill=True, color='k')
+        ax.set_xlabel("ADC Count")
+        ax.set_ylabel("Count")
+    else:
+        fig, ax, stairs = figure
+        stairs.set_data(counts, bins)
+        ax.relim()
+        ax.autoscale_view()
+    ax.set_title(f"Channel {channel} {ext_str} ADC Histogram:\n Run {run_id} {dt_title}")
+    fig.savefig(os.path.join(FIGURE_PATH, save_name))
+    return fig, ax, stairs
 
 def parse():
     parser = argparse.ArgumentParser(description="Plot a histogram of ADC count extrema.")
@@ -119,29 +221,15 @@ def main():
     run_time = data.get_datetime()
     run_id = data.get_run_id()
 
-    max_array = np.zeros(len(records))
-    min_array = np.zeros(len(records))
-    mismatch_cnt = 0
-    for idx, record in enumerate(records):
-        try:
-            adcs = data.extract(record)
-            wf = median_subtraction(adcs)[:800, channel] # Limiting total window size for now.
-            max_val = np.max(wf)
-            max_idx = np.where(wf == max_val)[0][0]
-            min_val = np.min( wf[max_idx:(max_idx+50)] )
-            max_array[idx] = max_val
-            min_array[idx] = min_val
-        except ValueError:
-            mismatch_cnt += 1
+    wfs, mismatch_cnt = extract_channel_batch(data, records, channel)
 
     ### Analysis/Processing & Plotting
-    # Waveforms that have a shape mismatch did not get updated, so remove those entries.
-    max_array = max_array[max_array != 0]
-    min_array = min_array[min_array != 0]
+    # Waveforms that have a shape mismatch were never added.
+    max_array, min_array = get_window_extrema(wfs)
 
-    plot_hist(max_array, run_time, run_id, "Maximum", channel, savetype)
+    figure = plot_hist(max_array, run_time, run_id, "Maximum", channel, savetype)
     save_hist(max_array, run_time, "Maximum", channel)
-    plot_hist(min_array, run_time, run_id, "Minimum", channel, savetype)
+    plot_hist(min_array, run_time, run_id, "Minimum", channel, savetype, figure)
     save_hist(min_array, run_time, "Minimum", channel)
 
     sys.exit(0)
@@ -4,15 +4,17 @@ Plot a single cosmic event.
 import os
 import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 import daqdataformats
-import detdataformats
-import detchannelmaps
 import fddetdataformats
 from hdf5libs import HDF5RawDataFile
 from rawdatautils.unpack.wibeth import np_array_adc
@@ -32,13 +34,42 @@ DT_FORMAT = "%Y%m%dT%H%M%S" # datetime format from hdf5 files.
 
 FIGURE_PATH = "./figures/kinks"
 
+H5_FILES = {} # HDF5RawDataFile handles opened by this process, keyed on file name.
+PLOT_FIGURES = {} # (fig, ax, im) reused by this process, keyed on plot function name.
+
 CH_MAP = [112, 113, 115, 116, 118, 119, 120, 121, 123, 124, 126, 127, 64, 65, 67, 68, 70, 71, 72, 73, 75, 76, 78, 79, 48, 49, 51, 52, 54, 55, 56, 57, 59, 60, 62, 63, 0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 50, 53, 58, 61, 2, 5, 10, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 114, 117, 122, 125, 66, 69, 74, 77]
 
-def ped_sub(adcs):
+# Inverse of CH_MAP: INV_CH_MAP[det_link * 64 + ch] is the mapped channel.
+INV_CH_MAP = np.empty(TOTAL_CHANNELS, dtype=np.int64)
+INV_CH_MAP[CH_MAP] = np.arange(TOTAL_CHANNELS)
+# LINK_CH_MAP[det_link] holds the mapped channels of all 64 channels on a link.
+LINK_CH_MAP = INV_CH_MAP.reshape(-1, CHANNELS_PER_WIB)
+
+def fast_median(adcs, axis):
+    """
+    Floored median of integer :adcs: along :axis: by partitioning instead of sorting.
+    Matches np.floor(np.median(adcs, axis=axis)) in the dtype of :adcs:.
+    """
+    num = adcs.shape[axis]
+    k = num // 2
+    if num % 2:
+        return np.partition(adcs, k, axis=axis).take(k, axis=axis)
+    part = np.partition(adcs, (k-1, k), axis=axis)
+    low = part.take(k-1, axis=axis).astype(np.int64)
+    return ((low + part.take(k, axis=axis)) // 2).astype(adcs.dtype)
+
+def ped_sub(adcs, median=None):
     """
-    Pedestal subtract the ADCs.
+    Pedestal subtract the ADCs in place.
+        adcs
+            2D signed integer array of (time, channels).
+        median
+            Optional per channel median to use instead of computing it again.
     """
-    return (adcs.T - np.floor(np.median(adcs, axis=1))).T.astype('int')
+    if median is None:
+        median = fast_median(adcs, 0)
+    np.subtract(adcs, median.astype(adcs.dtype), out=adcs)
+    return adcs
 
 def check_cosmic(h5_file, record, hit_threshold = HIT_THRESHOLD, channel_threshold = CHANNEL_THRESHOLD):
     """
@@ -51,11 +82,13 @@ def check_cosmic(h5_file, record, hit_threshold = HIT_THRESHOLD, channel_thresho
             Events with pedestal translated adc greather than this threshold is considered a hit.
         channel_threshold
             Events with hit channels greater than this threshold are considered as cosmic events.
-    Returns true if this record is a cosmic and false otherwise.
+    Returns (is_cosmic, per_gid_adcs) where is_cosmic is true if this record is a cosmic
+    and per_gid_adcs is a dict of {gid: (tmp_adc, median)} for the fragments that were read.
     """
     wib_geo_ids = h5_file.get_geo_ids(record)
 
     hits = 0
+    per_gid_adcs = {}
     for gid in wib_geo_ids:
         frag = h5_file.get_frag(record, gid)
         frag_type = frag.get_fragment_type()
@@ -66,51 +99,94 @@ def check_cosmic(h5_file, record, hit_threshold = HIT_THRESHOLD, channel_thresho
         if tmp_adc.shape[0] < FRAMES_PER_RECORD:
             continue
 
-        for ch in range(CHANNELS_PER_WIB):
-            hits += np.max(tmp_adc[:,ch]  -  np.median(tmp_adc[:,ch])) > hit_threshold
+        max_adc = tmp_adc.max(axis=0)
+        median_adc = fast_median(tmp_adc, 0)
+        hits += int(np.count_nonzero((max_adc - median_adc) > hit_threshold))
+        per_gid_adcs[gid] = (tmp_adc, median_adc)
 
-    if hits > channel_threshold:
-        return True
-    return False
+    return hits > channel_threshold, per_gid_adcs
 
-def extract_adcs(h5_file, record):
-    wib_geo_ids = h5_file.get_geo_ids(record)
-    #adcs = np.zeros( (len(wib_geo_ids) * CHANNELS_PER_WIB, FRAMES_PER_RECORD), dtype='int64' )
-    adcs = np.zeros( (TOTAL_CHANNELS, FRAMES_PER_RECORD), dtype='int64' )
-
-    for gid in wib_geo_ids:
-        frag = h5_file.get_frag(record, gid)
-        frag_type = frag.get_fragment_type()
-        if (frag_type != daqdataformats.FragmentType.kWIBEth):
-            continue
+def extract_adcs_cached(per_gid_adcs):
+    """
+    Channel map the fragments that check_cosmic already read.
+        per_gid_adcs
+            Dict of {gid: (tmp_adc, median)} from check_cosmic.
+    Returns the (time, channels) ADCs and the per channel median to pedestal subtract with.
+    The cached median is reused when the fragment is exactly one record long.
+    """
+    # Time-major, as the fragments and imshow both want it. 14-bit ADCs fit in int16.
+    adcs = np.zeros( (FRAMES_PER_RECORD, TOTAL_CHANNELS), dtype='int16' )
+    median = np.zeros(TOTAL_CHANNELS, dtype=np.int64)
 
+    for gid, (tmp_adc, median_adc) in per_gid_adcs.items():
         det_link = 0xffff & (gid >> 48)
 
-        tmp_adc = np_array_adc(frag)
-        if tmp_adc.shape[0] < FRAMES_PER_RECORD:
-            continue
-        tmp_adc = tmp_adc[:FRAMES_PER_RECORD, :]
+        if tmp_adc.shape[0] != FRAMES_PER_RECORD:
+            tmp_adc = tmp_adc[:FRAMES_PER_RECORD, :]
+            median_adc = fast_median(tmp_adc, 0)
 
-        for ch in range(CHANNELS_PER_WIB):
-            mapped_ch = CH_MAP.index(det_link * 64 + ch)
-            adcs[mapped_ch, :] = tmp_adc.T[ch, :]
+        mapped_chs = LINK_CH_MAP[det_link]
+        adcs[:, mapped_chs] = tmp_adc
+        median[mapped_chs] = median_adc
 
-    return adcs
+    return adcs, median
 
-def plot(adcs, dt_title, trig_id):
+def plot(adcs, dt_title, trig_id, savetype="svg", figure=None):
     """
     Given :adcs: is in the traditional 50L ADCs plot format and :dt_title: is datetime
     object to be used in the title.
-    Also include :non_cosm_count: in the title.
+        trig_id
+            Trigger ID; used in the plot title and save name.
+        savetype
+            Image format to save as.
+        figure
+            Optional (fig, ax, im) from a previous call to draw into instead of a new figure.
+    Returns the (fig, ax, im) that was drawn into so it can be reused.
+    """
+    if figure is None:
+        fig, ax = plt.subplots()
+        im = ax.imshow(adcs, vmin=-150, vmax=150, aspect='auto', origin='lower', interpolation='nearest')
+        ax.set_xlabel("Channels")
+        ax.set_ylabel("Time tick (512 ns / tick)")
+        fig.colorbar(im)
+    else:
+        fig, ax, im = figure
+        im.set_data(adcs)
+        im.set_extent((-0.5, adcs.shape[1] - 0.5, -0.5, adcs.shape[0] - 0.5))
+    ax.set_title("50L Cosmic Event: {} -- Trigger ID {}".format(str(dt_title), trig_id))
+    fig.savefig(os.path.join(FIGURE_PATH, "cosmic_event_TID{}_{}.{}".format(trig_id, dt_title.strftime(DT_FORMAT), savetype)))
+    return fig, ax, im
+
+def open_h5_file(h5_file_name):
+    """
+    Open h5_file_name once per process and reuse the handle afterwards.
+    """
+    if h5_file_name not in H5_FILES:
+        H5_FILES[h5_file_name] = HDF5RawDataFile(h5_file_name)
+    return H5_FILES[h5_file_name]
+
+def process_record(h5_file_name, record, trig_id, run_time, savetype):
+    """
+    Plot the record if it is a cosmic. Used by the --save-all process pool, so each
+    worker reads through its own HDF5 handle.
+        h5_file_name
+            Name of the HDF5 data file.
+        record
+            Record that specifies which trigger record in the file.
+        trig_id
+            Trigger ID to use in the plot title and save name.
+        run_time
+            datetime object to use in the plot title and save name.
+        savetype
+            Image format to save as.
+    Returns true if this record is a cosmic and false otherwise.
     """
-    plt.figure()
-    plt.imshow(adcs.T, vmin=-150, vmax=150, aspect='auto', origin='lower')
-    plt.xlabel("Channels")
-    plt.ylabel("Time tick (512 ns / tick)")
-    plt.title("50L Cosmic Event: {} -- Trigger ID {}".format(str(dt_title), trig_id))
-    plt.colorbar()
-    plt.savefig(os.path.join(FIGURE_PATH, "cosmic_event_TID{}_{}.svg".format(trig_id, dt_title.strftime(DT_FORMAT))))
-    plt.close()
+    is_cosmic, per_gid_adcs = check_cosmic(open_h5_file(h5_file_name), record)
+    if is_cosmic:
+        adcs, median = extract_adcs_cached(per_gid_adcs)
+        adcs = ped_sub(adcs, median)
+        PLOT_FIGURES["plot"] = plot(adcs, run_time, trig_id, savetype, PLOT_FIGURES.get("plot"))
+    return is_cosmic
 
 def parse():
     parser = argparse.ArgumentParser(description="Plot an event or all events from the specified HDF5 file.")
@@ -118,6 +194,7 @@ def parse():
     parser.add_argument('-c', type=int, help="Specify which cosmic event to display, as in the first, second, third, ..., n-th. Default: 1 (first).", default=1, metavar='n')
     parser.add_argument("--save-all", action="store_true", help="Pass to save all cosmic events. Voids -c.")
     parser.add_argument("--tqdm", action="store_true", help="Pass to use the tqdm progress bar. Only used for --save-all.")
+    parser.add_argument("--savetype", type=str, help="Specify the format to save the figure as. Default: svg, or png with --save-all.", default=None)
 
     assert (parser.parse_args().filename[-4:] == "hdf5"), "File name is not an HDF5 data file."
 
@@ -130,6 +207,9 @@ def main():
     cosm_order = args.c
     save_all = args.save_all
     use_tqdm = args.tqdm
+    savetype = args.savetype
+    if savetype is None: # Bulk saving renders far faster as png.
+        savetype = "png" if save_all else "svg"
 
     if not os.path.isdir(FIGURE_PATH):
         print(f"Saving figures to {FIGURE_PATH}.")
@@ -141,22 +221,25 @@ def main():
 
     # Don't consider counting the cosmic triggers, just save all.
     if save_all:
-        for trig_id, record in tqdm(enumerate(records), total=len(records),  disable=not use_tqdm, desc="Records"):
-            if check_cosmic(h5_file, record):
-                adcs = extract_adcs(h5_file, record)
-                adcs = ped_sub(adcs)
-                plot(adcs, run_time, trig_id)
+        num_workers = os.cpu_count()
+        chunksize = max(1, len(records) // (4 * num_workers)) # Amortize the IPC per task.
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = executor.map(process_record, repeat(h5_file_name), records, range(len(records)), repeat(run_time),
+                                   repeat(savetype), chunksize=chunksize)
+            for _ in tqdm(results, total=len(records), disable=not use_tqdm, desc="Records"):
+                pass
         sys.exit(0)
 
     # Do count the cosmic triggers. Only save one.
     trig_cnt = 0
     for trig_id, record in enumerate(records):
-        if check_cosmic(h5_file, record):
+        is_cosmic, per_gid_adcs = check_cosmic(h5_file, record)
+        if is_cosmic:
             trig_cnt += 1
             if trig_cnt == cosm_order:
-                adcs = extract_adcs(h5_file, record)
-                adcs = ped_sub(adcs)
-                plot(adcs, run_time, trig_id)
+                adcs, median = extract_adcs_cached(per_gid_adcs)
+                adcs = ped_sub(adcs, median)
+                plot(adcs, run_time, trig_id, savetype)
                 sys.exit(0)
     print("Reached end of events without finding the {}-th cosmic.".format(cosm_order))
     sys.exit(1) # Should this case be considered an exit(1)?
@@ -8,11 +8,32 @@ import argparse
 import datetime
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 import fiftyl_toolkit
 
+try:
+    from fast_histogram import histogram1d
+except ImportError:
+    histogram1d = None
+
+try:
+    from bottleneck import move_max
+except ImportError:
+    move_max = None
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """
+        Stand-in for numba.njit that leaves the function as plain Python.
+        """
+        return lambda func: func
+
 __author__ = "Alejandro Oranday"
 __contact__ = "alejandro@oran.day"
 
@@ -22,6 +43,7 @@ FIGURE_PATH = "./figures/bin-50/induction"
 SAVE_PATH = "./saved_arrays/threshold-100/induction"
 
 BINS = np.arange(0, 5001, 50)
+WINDOWS_PER_RECORD = 32 # Initial guess for sizing the area buffer; it grows if exceeded.
 PREFIX = 5
 SUFFIX = 5
 THRESHOLD = 100
@@ -30,30 +52,116 @@ INDUCTION1_CENTER = 68
 INDUCTION2_CENTER = 108
 INDUCTION_WINDOW = 15
 
+def fast_median(adcs, axis):
+    """
+    Floored median of integer :adcs: along :axis: by partitioning instead of sorting.
+    Matches np.floor(np.median(adcs, axis=axis)) in the dtype of :adcs:.
+    """
+    num = adcs.shape[axis]
+    k = num // 2
+    if num % 2:
+        return np.partition(adcs, k, axis=axis).take(k, axis=axis)
+    part = np.partition(adcs, (k-1, k), axis=axis)
+    low = part.take(k-1, axis=axis).astype(np.int64)
+    return ((low + part.take(k, axis=axis)) // 2).astype(adcs.dtype)
+
 def median_subtraction(adcs):
     """
     Median subtract the ADCs.
+    The 14-bit ADCs fit in int16, so the result is an int16 copy subtracted in place.
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    wfs = adcs.astype(np.int16)
+    np.subtract(wfs, fast_median(wfs, 0), out=wfs)
+    return wfs
 
-def check_muon(wfs):
+def histogram(areas, bins=BINS):
     """
-    If all three channels are active, call it a muon.
+    Histogram areas into the uniform width bins.
+    Uses fast_histogram when it is available and falls back to np.histogram.
+    Returns the counts for each bin.
     """
-    return np.all(wfs > THRESHOLD)
-
-def check_induction(ind1_wfs, ind2_wfs, time):
+    areas = np.asarray(areas)
+    if histogram1d is None:
+        counts, _ = np.histogram(areas, bins=bins)
+        return counts
+    counts = histogram1d(areas, bins=len(bins)-1, range=(bins[0], bins[-1]))
+    counts[-1] += np.count_nonzero(areas == bins[-1]) # np.histogram includes the last edge.
+    return counts
+
+def rolling_max(wfs, window):
+    """
+    Rolling max over the previous :window: ticks, inclusive, across all channels of :wfs:.
+    The windows are truncated at the start of the record.
+    Uses bottleneck when it is available and falls back to sliding_window_view.
+    Returns a 1D int64 array of (num_frames,).
+    """
+    tick_max = wfs.max(axis=1)
+    if move_max is None:
+        # Padding with the first tick leaves the truncated window maxima unchanged.
+        tick_max = np.pad(tick_max, (window-1, 0), mode='edge')
+        roll_max = np.lib.stride_tricks.sliding_window_view(tick_max, window).max(axis=-1)
+    else:
+        # bottleneck only has C kernels for int32/int64/float; int16 input drops to its slow Python path.
+        roll_max = move_max(tick_max.astype(np.int64), window=window, min_count=1)
+    return roll_max.astype(np.int64)
+
+@njit(cache=True)
+def accumulate_windows(wfs, ind1_max, ind2_min, use_induction, threshold, prefix, suffix, induction_threshold):
     """
-    If the center induction channels are above threshold, return True.
-    Requires a time shift compared to collection.
+    Sum the ADCs of each window where the center channel is above threshold.
+        wfs
+            2D array of (num_frames, 3) for the center channel and its adjacent channels.
+        ind1_max, ind2_min
+            1D arrays of (num_frames,) with the rolling induction 1 max and induction 2 min
+            over the induction window ending at each tick. Only used with use_induction.
+        use_induction
+            If True, only keep windows in coincidence with the induction planes.
+        threshold
+            ADC threshold for the center channel. Ticks with all three channels above are muons.
+        prefix, suffix
+            Number of ticks to include before and after a window.
+        induction_threshold
+            Induction threshold that both planes must cross near the window end.
+    Returns a 2D array of (num_windows, 4) with the (low, center, high, total) areas,
+    the number of muon ticks, and the number of windows skipped by the induction check.
     """
-    early_time = time - INDUCTION_WINDOW
-    if early_time < 0:
-        early_time = 0
+    num_frames = wfs.shape[0]
+    areas = np.zeros((num_frames, 4), dtype=np.int64)
+    sums = np.zeros(3, dtype=np.int64) # (low, center, high)
+    num_windows = 0
+    muon_count = 0
+    induction_skip = 0
 
-    ind1_window = ind1_wfs[early_time:time+1]
-    ind2_window = ind2_wfs[early_time:time+1]
-    return np.max(ind1_window) > INDUCTION_THRESHOLD and -1*np.min(ind2_window) > INDUCTION_THRESHOLD
+    for time in range(num_frames):
+        if wfs[time, 0] > threshold and wfs[time, 1] > threshold and wfs[time, 2] > threshold:
+            muon_count += 1
+            continue
+        if wfs[time, 1] > threshold:
+            start = time # Continue Window Case
+            if sums[1] == 0: ## Start New Window Case
+                start = max(time - prefix, 0)
+            for tick in range(start, time+1):
+                for ch in range(3):
+                    sums[ch] += wfs[tick, ch]
+        elif sums[1] != 0: ## End Window Case
+            in_coincidence = True
+            if use_induction:
+                in_coincidence = ind1_max[time] > induction_threshold and -1*ind2_min[time] > induction_threshold
+
+            if in_coincidence:
+                for tick in range(time, min(time + suffix, num_frames)):
+                    for ch in range(3):
+                        sums[ch] += wfs[tick, ch]
+                areas[num_windows, :3] = sums
+                areas[num_windows, 3] = sums[0] + sums[1] + sums[2]
+                num_windows += 1
+            else:
+                induction_skip += 1
+
+            ## Reset
+            sums[:] = 0
+
+    return areas[:num_windows], muon_count, induction_skip
 
 def parse():
     parser = argparse.ArgumentParser(description="Calculate the area under peaks and plot in a histogram.")
@@ -76,51 +184,64 @@ def mkdirs(path):
 def save(data, channel, run_id, sub_run_id):
     """
     Save data to a numpy file.
+    Window areas of 14-bit ADCs fit in int32, so they are saved at half the size of the int64 sums.
     """
     savename = f"adc-integral_channel-{channel}_run-{run_id}.{sub_run_id}.npy"
     savepath = os.path.join(SAVE_PATH, savename)
     with open(savepath, 'wb') as f:
-        np.save(f, data)
+        np.save(f, data.astype(np.int32, copy=False))
 
-def plot_all(areas, channel, num_events, run_time, run_id, savetype):
+def plot_all(areas, channel, num_events, run_time, run_id, savetype, figure=None):
     """
     Plot a histogram of the ADC areas including adjacent channels.
+    Draws into :figure:, the (fig, ax, stairs) from a previous histogram plot, when given.
+    Returns the (fig, ax, stairs) that was drawn into so it can be reused.
     """
     savename = f"adj-adc-integral_channel-{channel}_run-{run_id}_{run_time.strftime(DT_FORMAT)}.{savetype}"
     savepath = os.path.join(FIGURE_PATH, savename)
 
-    count, _ = np.histogram(areas, bins=BINS)
-    num_hist = np.sum(count)
-
-    plt.figure(figsize=(6,4))
-    plt.title(f"ADC Integral: Channel {channel}±1\n Total Count: {num_hist} Run {run_id} : {run_time}")
-    plt.hist(areas, bins=BINS, color='k')
-    plt.xlabel(f"ADC Area (Bin Width = {BINS[1] - BINS[0]})")
-    plt.ylim((0, 125))
-    plt.yticks(np.arange(0,126,25))
-    plt.tight_layout()
-    plt.savefig(savepath)
-    plt.close()
-
-def plot(areas, channel, num_events, run_time, run_id, savetype):
+    count = histogram(areas)
+    num_hist = int(np.sum(count))
+
+    if figure is None:
+        fig, ax = plt.subplots(figsize=(6,4))
+        stairs = ax.stairs(count, BINS, fill=True, color='k')
+        ax.set_xlabel(f"ADC Area (Bin Width = {BINS[1] - BINS[0]})")
+        ax.set_ylim((0, 125))
+        ax.set_yticks(np.arange(0, 126, 25))
+    else:
+        fig, ax, stairs = figure
+        stairs.set_data(count)
+    ax.set_title(f"ADC Integral: Channel {channel}±1\n Total Count: {num_hist} Run {run_id} : {run_time}")
+    fig.tight_layout()
+    fig.savefig(savepath)
+    return fig, ax, stairs
+
+def plot(areas, channel, num_events, run_time, run_id, savetype, figure=None):
     """
     Plot a histogram of the ADC areas.
+    Draws into :figure:, the (fig, ax, stairs) from a previous histogram plot, when given.
+    Returns the (fig, ax, stairs) that was drawn into so it can be reused.
     """
     savename = f"adc-integral_channel-{channel}_run-{run_id}_{run_time.strftime(DT_FORMAT)}.{savetype}"
     savepath = os.path.join(FIGURE_PATH, savename)
 
-    count, _ = np.histogram(areas, bins=BINS)
-    num_hist = np.sum(count)
-
-    plt.figure(figsize=(6,4))
-    plt.title(f"ADC Integral: Channel {channel}\n Total Count: {num_hist} Run {run_id} : {run_time}")
-    plt.hist(areas, bins=BINS, color='k')
-    plt.xlabel(f"ADC Area (Bin Width = {BINS[1] - BINS[0]})")
-    plt.ylim((0, 125))
-    plt.yticks(np.arange(0, 126, 25))
-    plt.tight_layout()
-    plt.savefig(savepath)
-    plt.close()
+    count = histogram(areas)
+    num_hist = int(np.sum(count))
+
+    if figure is None:
+        fig, ax = plt.subplots(figsize=(6,4))
+        stairs = ax.stairs(count, BINS, fill=True, color='k')
+        ax.set_xlabel(f"ADC Area (Bin Width = {BINS[1] - BINS[0]})")
+        ax.set_ylim((0, 125))
+        ax.set_yticks(np.arange(0, 126, 25))
+    else:
+        fig, ax, stairs = figure
+        stairs.set_data(count)
+    ax.set_title(f"ADC Integral: Channel {channel}\n Total Count: {num_hist} Run {run_id} : {run_time}")
+    fig.tight_layout()
+    fig.savefig(savepath)
+    return fig, ax, stairs
 
 def main():
     ### Process Arguments
@@ -152,92 +273,45 @@ def main():
     muon_count = 0
     induction_skip = 0
 
-    low_areas = []
-    center_areas = []
-    high_areas = []
-    total_areas = []
+    extract_channels = [channel-1, channel, channel+1]
+    if induction:
+        extract_channels += [INDUCTION1_CENTER-1, INDUCTION1_CENTER, INDUCTION1_CENTER+1,
+                             INDUCTION2_CENTER-1, INDUCTION2_CENTER, INDUCTION2_CENTER+1]
+
+    all_areas = np.empty((len(records) * WINDOWS_PER_RECORD, 4), dtype=np.int64) # (low, center, high, total)
+    num_windows = 0
 
     for record in tqdm(records, total=len(records), desc="Records", disable=not use_tqdm):
         try:
-            wfs = data.extract(record, [channel-1, channel, channel+1])
-            wfs = median_subtraction(wfs) # (num_frames, num_channels)
-
-            if induction:
-                ind1_wfs = data.extract(record, [INDUCTION1_CENTER-1, INDUCTION1_CENTER, INDUCTION1_CENTER+1])
-                ind1_wfs = median_subtraction(ind1_wfs)
-
-                ind2_wfs = data.extract(record, [INDUCTION2_CENTER-1, INDUCTION2_CENTER, INDUCTION2_CENTER+1])
-                ind2_wfs = median_subtraction(ind2_wfs)
-
-            low_sum = 0
-            center_sum = 0
-            high_sum = 0
-            total_sum = 0
-
-            for time in range(wfs.shape[0]):
-                if check_muon(wfs[time, :]):
-                    muon_count += 1
-                    continue
-                if wfs[time, 1] > adc_threshold:
-                    ## Start New Window Case
-                    if center_sum == 0:
-                        if time < prefix:
-                            prefix = time
-
-                        low_sum += np.sum(wfs[time-prefix:time+1, 0])
-                        center_sum += np.sum(wfs[time-prefix:time+1, 1])
-                        high_sum += np.sum(wfs[time-prefix:time+1, 2])
-                        total_sum += np.sum(wfs[time-prefix:time+1, :])
-
-                        prefix = PREFIX
-                    else: ## Continue Window Case
-                        low_sum += wfs[time, 0]
-                        center_sum += wfs[time, 1]
-                        high_sum += wfs[time, 2]
-                        total_sum += np.sum(wfs[time,:])
-                elif center_sum != 0: ## End Window Case
-                    if induction: # Use induction coincidence.
-                        if check_induction(ind1_wfs, ind2_wfs, time):
-                            if wfs.shape[0] < time+suffix:
-                                suffix = wfs.shape[0] - time
-
-                            low_sum += np.sum(wfs[time:time+suffix, 0])
-                            center_sum += np.sum(wfs[time:time+suffix, 1])
-                            high_sum += np.sum(wfs[time:time+suffix, 2])
-                            total_sum += np.sum(wfs[time:time+suffix, :])
-
-                            suffix = SUFFIX
-
-                            low_areas.append(low_sum)
-                            center_areas.append(center_sum)
-                            high_areas.append(high_sum)
-                            total_areas.append(total_sum)
-                        else:
-                            induction_skip += 1
-                    else: # Same effect, but don't check induction coincidence.
-                        if wfs.shape[0] < time+suffix:
-                            suffix = wfs.shape[0] - time
-
-                        low_sum += np.sum(wfs[time:time+suffix, 0])
-                        center_sum += np.sum(wfs[time:time+suffix, 1])
-                        high_sum += np.sum(wfs[time:time+suffix, 2])
-                        total_sum += np.sum(wfs[time:time+suffix, :])
-
-                        suffix = SUFFIX
-
-                        low_areas.append(low_sum)
-                        center_areas.append(center_sum)
-                        high_areas.append(high_sum)
-                        total_areas.append(total_sum)
-
-                    ## Reset
-                    low_sum = 0
-                    center_sum = 0
-                    high_sum = 0
-                    total_sum = 0
+            all_wfs = data.extract(record, extract_channels) # One read for the center and induction channels.
+            wfs = median_subtraction(all_wfs[:, :3]) # (num_frames, num_channels)
+
+            # Induction is only checked when a window closes, which needs the center above threshold.
+            if induction and (wfs[:, 1] > adc_threshold).any():
+                ind_wfs = median_subtraction(all_wfs[:, 3:])
+                ind1_max = rolling_max(ind_wfs[:, :3], INDUCTION_WINDOW+1)
+                ind2_min = -1*rolling_max(-1*ind_wfs[:, 3:], INDUCTION_WINDOW+1)
+            else: # Unused, but keeps the argument types fixed for numba.
+                ind1_max = ind2_min = np.empty(0, dtype=np.int64)
+
+            areas, muons, skips = accumulate_windows(wfs, ind1_max, ind2_min, induction, adc_threshold,
+                                                     prefix, suffix, INDUCTION_THRESHOLD)
+            muon_count += muons
+            induction_skip += skips
+
+            if num_windows + len(areas) > len(all_areas):
+                all_areas = np.resize(all_areas, (max(2*len(all_areas), num_windows + len(areas)), 4))
+            all_areas[num_windows:num_windows + len(areas)] = areas
+            num_windows += len(areas)
         except ValueError:
             mismatch += 1
 
+    all_areas = all_areas[:num_windows]
+    low_areas = all_areas[:, 0]
+    center_areas = all_areas[:, 1]
+    high_areas = all_areas[:, 2]
+    total_areas = all_areas[:, 3]
+
     print("#### Sums ####")
     print("Low Area Sum:", np.sum(low_areas))
     print("Center Area Sum:", np.sum(center_areas))
@@ -252,19 +326,21 @@ def main():
     print("")
 
     print("#### Counts ####")
-    counts, _ = np.histogram(center_areas, bins=BINS)
-    print("Histogram Count:", np.sum(counts))
+    counts = histogram(center_areas)
+    print("Histogram Count:", int(np.sum(counts)))
 
     num_events = len(records) - mismatch
     print("Total Events:", num_events)
 
-    plot(low_areas, channel-1, num_events, run_time, run_id, savetype)
-    plot(center_areas, channel, num_events, run_time, run_id, savetype)
-    plot(high_areas, channel+1, num_events, run_time, run_id, savetype)
+    # All four histograms share one figure.
+    figure = plot(low_areas, channel-1, num_events, run_time, run_id, savetype)
+    figure = plot(center_areas, channel, num_events, run_time, run_id, savetype, figure)
+    figure = plot(high_areas, channel+1, num_events, run_time, run_id, savetype, figure)
 
-    plot_all(total_areas, channel, num_events, run_time, run_id, savetype)
+    figure = plot_all(total_areas, channel, num_events, run_time, run_id, savetype, figure)
+    plt.close(figure[0])
 
-    np_areas = np.array([low_areas, center_areas, high_areas, total_areas])
+    np_areas = np.ascontiguousarray(all_areas.T)
     save(np_areas, channel, run_id, sub_run_id)
 
 if __name__ == "__main__":
@@ -7,6 +7,11 @@ import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 
+try:
+    from fast_histogram import histogram1d
+except ImportError:
+    histogram1d = None
+
 SAVE_PATH = "."
 OFF_CHANNEL = 20
 ON_CHANNEL = 24
@@ -26,9 +31,22 @@ d = 52 # cm. Vertical drift from source to collection plane.
 A = 2 # cm. Position offset of center of channel.
 B = 0 # cm. Position offset of center of channel.
 
+def histogram(areas, bins=BINS):
+    """
+    Histogram areas into the uniform width bins.
+    Uses fast_histogram when it is available and falls back to np.histogram.
+    Returns the counts for each bin.
+    """
+    areas = np.asarray(areas)
+    if histogram1d is None:
+        counts, _ = np.histogram(areas, bins=bins)
+        return counts
+    counts = histogram1d(areas, bins=len(bins)-1, range=(bins[0], bins[-1]))
+    counts[-1] += np.count_nonzero(areas == bins[-1]) # np.histogram includes the last edge.
+    return counts
+
 def load(filename):
-    with open(filename, 'rb') as f:
-        d = np.load(f)
+    d = np.load(filename, mmap_mode='r') # Only the rows that get used are read.
     low_areas = d[0, :]
     center_areas = d[1, :]
     high_areas = d[2, :]
@@ -50,8 +68,8 @@ def process_files():
 
     for file in args.files:
         _, center_areas, _, total_areas = load(os.path.join(SAVE_PATH, file))
-        center_count, _ = np.histogram(center_areas, bins=BINS)
-        total_count, _ = np.histogram(total_areas, bins=BINS)
+        center_count = histogram(center_areas)
+        total_count = histogram(total_areas)
         if str(ON_CHANNEL) in file:
             on_center_count += center_count
             on_total_count += total_count
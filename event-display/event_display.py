@@ -4,9 +4,16 @@ Plot a single snapshot (may contain nothing of note).
 import os
 import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+from itertools import repeat
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
+matplotlib.rcParams["svg.fonttype"] = "none" # Keep text as text instead of glyph paths.
+matplotlib.rcParams["path.simplify_threshold"] = 1.0 # Merge sub-pixel line segments in saved paths.
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import fiftyl_toolkit
@@ -16,15 +23,42 @@ __contact__ = "alejandro@oran.day"
 
 FIGURE_PATH = "./figures"
 
+DATA_FILES = {} # fiftyl_toolkit.Data handles opened by this process, keyed on file name.
+PLOT_FIGURES = {} # (fig, ax, im) reused by this process, keyed on plot function name.
+
 DT_FORMAT = "%Y%m%dT%H%M%S"
 
+def fast_median(adcs, axis):
+    """
+    Floored median of integer :adcs: along :axis: by partitioning instead of sorting.
+    Matches np.floor(np.median(adcs, axis=axis)) in the dtype of :adcs:.
+    """
+    num = adcs.shape[axis]
+    k = num // 2
+    if num % 2:
+        return np.partition(adcs, k, axis=axis).take(k, axis=axis)
+    part = np.partition(adcs, (k-1, k), axis=axis)
+    low = part.take(k-1, axis=axis).astype(np.int64)
+    return ((low + part.take(k, axis=axis)) // 2).astype(adcs.dtype)
+
 def median_subtraction(adcs):
     """
     Median subtract the ADCs.
+    The 14-bit ADCs fit in int16, so the result is an int16 copy subtracted in place.
+    """
+    wfs = adcs.astype(np.int16)
+    np.subtract(wfs, fast_median(wfs, 0), out=wfs)
+    return wfs
+
+@lru_cache(maxsize=None)
+def save_path_template(prefix, dt_title, savetype):
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    Save path for a snapshot with a %d placeholder for the trigger ID.
+    Cached, since everything but the trigger ID is fixed for a data file.
+    """
+    return os.path.join(FIGURE_PATH, f"{prefix}_TID%d_{dt_title.strftime(DT_FORMAT)}.{savetype}")
 
-def subplot(adcs, dt_title, run_id, trig_id, savetype):
+def subplot(adcs, dt_title, run_id, trig_id, savetype, figure=None):
     """
     Plot 3-pane ADCs for each of the 3 planes.
         adcs
@@ -37,28 +71,40 @@ def subplot(adcs, dt_title, run_id, trig_id, savetype):
             Trigger ID; used in the plot title.
         savetype
             Image format to save as.
+        figure
+            Optional (fig, ax, ims) from a previous call to draw into instead of a new figure.
+    Returns the (fig, ax, ims) that was drawn into so it can be reused.
     """
-    savename = f"50l-subplots-snapshot_TID{trig_id}_{dt_title.strftime(DT_FORMAT)}.{savetype}"
-    save_path = os.path.join(FIGURE_PATH, savename)
-
-    plane_channels = (("Collection", np.arange(0, 48)),
-                    ("Induction 1", np.arange(48, 88)),
-                    ("Induction 2", np.arange(88, 128)))
-
-    f, ax = plt.subplots(1,3, sharey=True)
-    plt.suptitle(f"50L Run {run_id} Snapshot: {dt_title} -- Trigger ID {trig_id}")
-    for idx, (plane, channels) in enumerate(plane_channels):
-        z_plot = ax[idx].imshow(adcs[:, channels], origin='lower')
-        ax[idx].set_title(plane)
-        plt.colorbar(z_plot, ax=ax[idx])
-        ax[idx].set_aspect(len(channels) / FRAMES_PER_RECORD)
-    f.supxlabel("Channels")
-    f.supylabel("Time tick (512 ns / tick)")
-    f.tight_layout()
-    plt.savefig(save_path)
-    plt.close()
-
-def plot(adcs, dt_title, run_id, trig_id, savetype):
+    save_path = save_path_template("50l-subplots-snapshot", dt_title, savetype) % trig_id
+
+    plane_channels = (("Collection", slice(0, 48)),
+                    ("Induction 1", slice(48, 88)),
+                    ("Induction 2", slice(88, 128)))
+    # One contiguous copy per plane, so imshow does not read strided column slices.
+    plane_adcs = [np.ascontiguousarray(adcs[:, channels]) for _, channels in plane_channels]
+
+    if figure is None:
+        f, ax = plt.subplots(1,3, sharey=True)
+        ims = []
+        for idx, ((plane, _), plane_adc) in enumerate(zip(plane_channels, plane_adcs)):
+            z_plot = ax[idx].imshow(plane_adc, origin='lower', interpolation='nearest')
+            ax[idx].set_title(plane)
+            f.colorbar(z_plot, ax=ax[idx])
+            ax[idx].set_aspect(plane_adc.shape[1] / plane_adc.shape[0])
+            ims.append(z_plot)
+        f.supxlabel("Channels")
+        f.supylabel("Time tick (512 ns / tick)")
+        f.tight_layout()
+    else:
+        f, ax, ims = figure
+        for z_plot, plane_adc in zip(ims, plane_adcs):
+            z_plot.set_data(plane_adc)
+            z_plot.autoscale() # Each pane is colored on its own record's range.
+    f.suptitle(f"50L Run {run_id} Snapshot: {dt_title} -- Trigger ID {trig_id}")
+    f.savefig(save_path)
+    return f, ax, ims
+
+def plot(adcs, dt_title, run_id, trig_id, savetype, figure=None):
     """
     Plot ADCs in the traditional 50L heatmap plot format.
         adcs
@@ -71,18 +117,59 @@ def plot(adcs, dt_title, run_id, trig_id, savetype):
             Trigger ID; used in the plot title.
         savetype
             Image format to save as.
+        figure
+            Optional (fig, ax, im) from a previous call to draw into instead of a new figure.
+    Returns the (fig, ax, im) that was drawn into so it can be reused.
+    """
+    save_path = save_path_template("50l-snapshot", dt_title, savetype) % trig_id
+
+    if figure is None:
+        fig, ax = plt.subplots()
+        im = ax.imshow(adcs, vmin=-150, vmax=150, aspect='auto', origin='lower', interpolation='nearest')
+        ax.set_xlabel("Channels")
+        ax.set_ylabel("Time tick (512 ns / tick)")
+        fig.colorbar(im)
+    else:
+        fig, ax, im = figure
+        im.set_data(adcs)
+        im.set_extent((-0.5, adcs.shape[1] - 0.5, -0.5, adcs.shape[0] - 0.5))
+    ax.set_title(f"50L Run {run_id} Snapshot: {dt_title} -- Trigger ID {trig_id}")
+    fig.savefig(save_path)
+    return fig, ax, im
+
+def open_data(h5_file_name):
+    """
+    Open h5_file_name once per process and reuse the handle afterwards.
+    """
+    if h5_file_name not in DATA_FILES:
+        DATA_FILES[h5_file_name] = fiftyl_toolkit.Data(h5_file_name)
+    return DATA_FILES[h5_file_name]
+
+def process_record(h5_file_name, record, trig_id, run_time, run_id, savetype, use_subplots):
+    """
+    Median subtract and plot a single record. Used by the --save-all process pool, so
+    each worker reads through its own data handle.
+        h5_file_name
+            Name of the HDF5 data file.
+        record
+            Record to extract from the data file.
+        trig_id
+            Trigger ID; used in the plot title.
+        run_time
+            datetime format of when the snapshot took place; used in the plot title.
+        run_id
+            Run ID of the data file.
+        savetype
+            Image format to save as.
+        use_subplots
+            If True, plot the 3 planes as subplots.
     """
-    savename = f"50l-snapshot_TID{trig_id}_{dt_title.strftime(DT_FORMAT)}.{savetype}"
-    save_path = os.path.join(FIGURE_PATH, savename)
-
-    plt.figure()
-    plt.imshow(adcs, vmin=-150, vmax=150, aspect='auto', origin='lower')
-    plt.xlabel("Channels")
-    plt.ylabel("Time tick (512 ns / tick)")
-    plt.title(f"50L Run {run_id} Snapshot: {dt_title} -- Trigger ID {trig_id}")
-    plt.colorbar()
-    plt.savefig(save_path)
-    plt.close()
+    adcs = open_data(h5_file_name).extract(record)
+    adcs = median_subtraction(adcs)
+    if use_subplots:
+        PLOT_FIGURES["subplot"] = subplot(adcs, run_time, run_id, trig_id, savetype, PLOT_FIGURES.get("subplot"))
+    else:
+        PLOT_FIGURES["plot"] = plot(adcs, run_time, run_id, trig_id, savetype, PLOT_FIGURES.get("plot"))
 
 def parse():
     parser = argparse.ArgumentParser(description="Plot a snapshot from the specified HDF5 file and trigger ID.")
@@ -90,7 +177,7 @@ def parse():
     parser.add_argument('--record', type=int, help="Trigger Record ID to plot. 0-index", default=0, metavar='n')
     parser.add_argument("--save-all", action="store_true", help="Pass to save snapshots of all trigger IDs")
     parser.add_argument("--tqdm", action="store_true", help="Display tqdm progress bar. Only used for --save-all.")
-    parser.add_argument("--savetype", type=str, help="Specify the format to save the figure as. Default: svg.", default="svg")
+    parser.add_argument("--savetype", type=str, help="Specify the format to save the figure as. Default: svg, or png with --save-all.", default=None)
     parser.add_argument("--subplots", action="store_true", help="Pass to display as 3 subplots for the 3 planes.")
     args = parser.parse_args()
 
@@ -108,6 +195,8 @@ def main():
     save_all = args.save_all
     use_tqdm = args.tqdm
     savetype = args.savetype
+    if savetype is None: # Bulk saving renders far faster as png.
+        savetype = "png" if save_all else "svg"
     use_subplots = args.subplots
 
     if not os.path.isdir(FIGURE_PATH):
@@ -120,13 +209,13 @@ def main():
     run_id = data.get_run_id()
 
     if save_all:
-        for trig_id, record in tqdm(enumerate(records), total=len(records), disable=not use_tqdm, desc="Records"):
-            adcs = data.extract(record)
-            adcs = median_subtraction(adcs)
-            if use_subplots:
-                subplot(adcs, run_time, run_id, trig_id, savetype)
-            else:
-                plot(adcs, run_time, run_id, trig_id, savetype)
+        num_workers = os.cpu_count()
+        chunksize = max(1, len(records) // (4 * num_workers)) # Amortize the IPC per task.
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = executor.map(process_record, repeat(h5_file_name), records, range(len(records)), repeat(run_time),
+                                   repeat(run_id), repeat(savetype), repeat(use_subplots), chunksize=chunksize)
+            for _ in tqdm(results, total=len(records), disable=not use_tqdm, desc="Records"):
+                pass
         sys.exit(0)
 
     # Not save_all case
@@ -4,9 +4,15 @@ Plot a single FFT plot for some trigger ID.
 import os
 import sys
 import argparse
+import queue
+import threading
 from datetime import datetime
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
+matplotlib.rcParams["svg.fonttype"] = "none" # Keep text as text instead of glyph paths.
+matplotlib.rcParams["path.simplify_threshold"] = 1.0 # Merge sub-pixel line segments in saved paths.
 import matplotlib.pyplot as plt
 
 import daqdataformats
@@ -14,27 +20,43 @@ import fddetdataformats
 from hdf5libs import HDF5RawDataFile
 from rawdatautils.unpack.wibeth import np_array_adc
 
+try:
+    from scipy.fft import rfft
+except ImportError:
+    rfft = None
+
 __author__ = "Alejandro Oranday"
 __contact__ = "alejandro@oran.day"
 
 DT_FORMAT = "%Y%m%dT%H%M%S" # datetime format from hdf5 files.
 FIGURE_PATH = "./figures"
 
+PREFETCH_DEPTH = 4 # Records read ahead of the processing.
+FFT_BATCH = 64 # Records transformed per rfft call.
+SUM_CHANNELS = 10 # Channels summed, starting from -c.
+
 FRAMES_PER_RECORD = 2240
 TOTAL_CHANNELS = 128
 CHANNELS_PER_WIB = 64
 
 CH_MAP = [112, 113, 115, 116, 118, 119, 120, 121, 123, 124, 126, 127, 64, 65, 67, 68, 70, 71, 72, 73, 75, 76, 78, 79, 48, 49, 51, 52, 54, 55, 56, 57, 59, 60, 62, 63, 0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 50, 53, 58, 61, 2, 5, 10, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 114, 117, 122, 125, 66, 69, 74, 77]
 
+# Inverse of CH_MAP: INV_CH_MAP[det_link * 64 + ch] is the mapped channel.
+INV_CH_MAP = np.empty(TOTAL_CHANNELS, dtype=np.int64)
+INV_CH_MAP[CH_MAP] = np.arange(TOTAL_CHANNELS)
+# LINK_CH_MAP[det_link] holds the mapped channels of all 64 channels on a link.
+LINK_CH_MAP = INV_CH_MAP.reshape(-1, CHANNELS_PER_WIB)
+
 def pedsub(adcs):
     """
-    Pedestal subtract the ADCs.
+    Pedestal subtract the (time, channels) ADCs in place.
     """
-    return (adcs.T - np.floor(np.median(adcs, axis=1))).T.astype('int')
+    adcs -= np.floor(np.median(adcs, axis=0)).astype(adcs.dtype)
+    return adcs
 
 def extract_adcs(h5_file, record):
     wib_geo_ids = h5_file.get_geo_ids(record)
-    adcs = np.zeros( (TOTAL_CHANNELS, FRAMES_PER_RECORD), dtype='int64' )
+    adcs = np.zeros( (FRAMES_PER_RECORD, TOTAL_CHANNELS), dtype='int16' ) # Time-major. 14-bit ADCs fit in int16.
 
     for gid in wib_geo_ids:
         frag = h5_file.get_frag(record, gid)
@@ -49,25 +71,52 @@ def extract_adcs(h5_file, record):
             continue
         tmp_adc = tmp_adc[:FRAMES_PER_RECORD, :]
 
-        for ch in range(CHANNELS_PER_WIB):
-            mapped_ch = CH_MAP.index(det_link * 64 + ch)
-            adcs[mapped_ch, :] = tmp_adc.T[ch, :]
+        mapped_chs = LINK_CH_MAP[det_link]
+        adcs[:, mapped_chs] = tmp_adc
 
     return adcs
 
+def prefetch(read, records, depth=PREFETCH_DEPTH):
+    """
+    Yield (record, result, error) for each record, where result is read(record).
+    A background thread reads up to :depth: records ahead so the HDF5 reads overlap
+    with processing. If read raises, result is None and error is the exception.
+    """
+    results = queue.Queue(maxsize=depth)
+
+    def producer():
+        for record in records:
+            try:
+                results.put((record, read(record), None))
+            except Exception as error:
+                results.put((record, None, error))
+
+    threading.Thread(target=producer, daemon=True).start()
+    for _ in range(len(records)):
+        yield results.get()
+
+def channel_rfft(adcs, axis):
+    """
+    Real FFT of :adcs: along the time :axis: as one batched call.
+    Uses scipy.fft across all cores when it is available and falls back to np.fft.
+    """
+    if rfft is None:
+        return np.fft.rfft(adcs, axis=axis)
+    return rfft(adcs, axis=axis, workers=-1)
+
 def fft_plot(fft, dt_title, ch_num):
     """
-    Plot the FFT plot for the given adc.
+    Plot the FFT magnitude spectrum :fft: for the given adc.
     """
-    plt.figure()
+    fig, ax = plt.subplots()
     freq = np.fft.rfftfreq(FRAMES_PER_RECORD, d=512e-9)
-    plt.plot(freq[1:], fft[1:].real, 'k')
-    #plt.xlim((0,1e6))
-    plt.yscale('symlog')
-    plt.xlabel("FFT Frequency (Hz)")
-    plt.title("Channel {}-{} Sum FFT: {}".format(ch_num, ch_num+10, str(dt_title)))
-    plt.savefig(os.path.join(FIGURE_PATH, "fft{}_{}.svg".format(ch_num, dt_title.strftime(DT_FORMAT))))
-    plt.close()
+    ax.plot(freq[1:], fft[1:], 'k')
+    #ax.set_xlim((0,1e6))
+    ax.set_yscale('symlog')
+    ax.set_xlabel("FFT Frequency (Hz)")
+    ax.set_title("Channel {}-{} Sum FFT: {}".format(ch_num, ch_num+SUM_CHANNELS, str(dt_title)))
+    fig.savefig(os.path.join(FIGURE_PATH, "fft{}_{}.svg".format(ch_num, dt_title.strftime(DT_FORMAT))))
+    plt.close(fig)
 
 def parse():
     parser = argparse.ArgumentParser(description="Plot the channel FFT for an event.")
@@ -89,15 +138,21 @@ def main():
     records = h5_file.get_all_record_ids()
     run_time = datetime.strptime(h5_file_name.split("_")[-1].split(".")[0], DT_FORMAT)
 
-    fft_sum = np.zeros((FRAMES_PER_RECORD // 2 + 1,))
-    for record in records:
-        adcs = extract_adcs(h5_file, record)
-
-        for idx in range(ch_num, ch_num+10):
-            fft = np.fft.rfft(adcs[idx,:])
-            fft_sum += np.abs(fft.real)
-
-    fft_plot(fft_sum / len(records), run_time, ch_num)
+    power_sum = np.zeros((FRAMES_PER_RECORD // 2 + 1,))
+    batch = np.zeros((FFT_BATCH, FRAMES_PER_RECORD, SUM_CHANNELS), dtype=np.int16) # (records, time, channels)
+    num_batched = 0
+    for idx, (_, adcs, error) in enumerate(prefetch(lambda record: extract_adcs(h5_file, record), records)):
+        if error is not None:
+            raise error
+
+        batch[num_batched] = adcs[:, ch_num:ch_num+SUM_CHANNELS]
+        num_batched += 1
+        if num_batched == FFT_BATCH or idx == len(records) - 1:
+            ffts = channel_rfft(batch[:num_batched], axis=1)
+            power_sum += (ffts.real**2 + ffts.imag**2).sum(axis=(0, 2)) # |F|^2 without a sqrt per bin.
+            num_batched = 0
+
+    fft_plot(np.sqrt(power_sum / len(records)), run_time, ch_num)
     sys.exit(0)
 
 if __name__ == "__main__":
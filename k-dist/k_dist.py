@@ -11,6 +11,11 @@ import matplotlib.pyplot as plt
 
 import fiftyl_toolkit
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
 __author__ = "Alejandro Oranday"
 __contact__ = "alejandro@oran.day"
 
@@ -34,28 +39,55 @@ ADJ_MASK = ((1,0),
             (-1,-1),
             (1,-1))
 
+def fast_median(adcs, axis):
+    """
+    Floored median of integer :adcs: along :axis: by partitioning instead of sorting.
+    Matches np.floor(np.median(adcs, axis=axis)) in the dtype of :adcs:.
+    """
+    num = adcs.shape[axis]
+    k = num // 2
+    if num % 2:
+        return np.partition(adcs, k, axis=axis).take(k, axis=axis)
+    part = np.partition(adcs, (k-1, k), axis=axis)
+    low = part.take(k-1, axis=axis).astype(np.int64)
+    return ((low + part.take(k, axis=axis)) // 2).astype(adcs.dtype)
+
 def median_subtraction(adcs):
     """
     Median subtract the ADCs.
+    The 14-bit ADCs fit in int16, so the result is an int16 copy subtracted in place.
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    wfs = adcs.astype(np.int16)
+    np.subtract(wfs, fast_median(wfs, 0), out=wfs)
+    return wfs
 
-def manhattan_dist(x, y):
+def identify_plane(channels):
     """
-    Return manhattan distance from 2-tuple x to 2-tuple y.
+    Identify the plane that each data point is on.
+        channels
+            1D array of the channel of each data point.
+    Returns an array of 0 (collection), 1 (induction 1), or 2 (induction 2).
     """
-    return np.abs(x[0] - y[0]) + np.abs(x[1] - y[1])
+    return np.where(channels < 48, 0, np.where(channels < 88, 1, 2))
 
-def identify_plane(x):
+def plane_k_dist(points, k):
     """
-    Identify the plane that data point x is on.
-        x
-            2-tuple of (channel, tick).
-    Returns 0 (collection), 1 (induction 1), or 2 (induction 2).
+    Manhattan distance from each point to its k-th nearest point in the same plane.
+        points
+            2D array of (num_points, 2) of (channel, tick).
+        k
+            Integer for the neighbor number of interest. Each point counts as its own 0-th neighbor.
+    Uses a cKDTree when scipy is available and falls back to the full distance matrix.
+    Returns a 1D array of (num_points,).
     """
-    if x[0] < 48: return 0
-    if x[0] < 88: return 1
-    return 2
+    if len(points) <= k:
+        raise IndexError(f"Only {len(points)} points in the plane; need more than k = {k}.")
+    if cKDTree is None:
+        dists = np.abs(points[:, None, :] - points[None, :, :]).sum(axis=-1)
+        return np.partition(dists, k, axis=1)[:, k]
+    # A list of neighbors keeps the result 2D even for k = 0, where query(k=1) would return 1D.
+    dists, _ = cKDTree(points).query(points, k=[k+1], p=1)
+    return dists[:, 0].astype(np.int64)
 
 def k_dist(adcs, k, dt_title, trig_id):
     """
@@ -75,21 +107,16 @@ def k_dist(adcs, k, dt_title, trig_id):
 
     hit_locations = np.where(adcs_ped_sub > ADC_THRESHOLD)
 
-    k_distance = []
-    for x in zip(hit_locations[0], hit_locations[1]):
-        dist = []
-        x_plane = identify_plane(x)
-
-        # Intentionally counts itself per the neighbor definition of DBSCAN
-        # Calculates distance to *all* points.
-        for y in zip(hit_locations[0], hit_locations[1]):
-            y_plane = identify_plane(y)
-            if x_plane == y_plane:
-                dist.append(manhattan_dist(x,y))
-        dist.sort()
-        k_distance.append(dist[k]) # Only keep the distance to the k-th point.
-
-    k_distance = sorted(k_distance, reverse=True)
+    points = np.column_stack(hit_locations)
+    planes = identify_plane(points[:, 0])
+
+    # Intentionally counts itself per the neighbor definition of DBSCAN
+    k_distance = np.zeros(len(points), dtype=np.int64)
+    for plane in np.unique(planes):
+        in_plane = planes == plane
+        k_distance[in_plane] = plane_k_dist(points[in_plane], k)
+
+    k_distance = np.sort(k_distance)[::-1]
     plt.figure()
     plt.scatter(range(len(k_distance)), k_distance, s=2, color='k')
     plt.title(f"{k}-dist: {dt_title} Trigger ID{trig_id}")
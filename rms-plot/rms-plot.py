@@ -4,9 +4,15 @@ Plot a single RMS plot for some trigger ID.
 import os
 import sys
 import argparse
+import queue
+import threading
 from datetime import datetime
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
+matplotlib.rcParams["svg.fonttype"] = "none" # Keep text as text instead of glyph paths.
+matplotlib.rcParams["path.simplify_threshold"] = 1.0 # Merge sub-pixel line segments in saved paths.
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
@@ -18,6 +24,38 @@ __contact__ = "alejandro@oran.day"
 DT_FORMAT = "%Y%m%dT%H%M%S" # datetime format from hdf5 files.
 FIGURE_PATH = "./figures"
 
+PREFETCH_DEPTH = 4 # Records read ahead of the processing.
+
+def prefetch(read, records, depth=PREFETCH_DEPTH):
+    """
+    Yield (record, result, error) for each record, where result is read(record).
+    A background thread reads up to :depth: records ahead so the HDF5 reads overlap
+    with processing. If read raises, result is None and error is the exception.
+    """
+    results = queue.Queue(maxsize=depth)
+
+    def producer():
+        for record in records:
+            try:
+                results.put((record, read(record), None))
+            except Exception as error:
+                results.put((record, None, error))
+
+    threading.Thread(target=producer, daemon=True).start()
+    for _ in range(len(records)):
+        yield results.get()
+
+def channel_rms(adcs):
+    """
+    Per channel standard deviation of :adcs:, a 2D array of (time, channels).
+    Equal to np.std(adcs, axis=0), but from one pass of exact int64 sums and sums of squares.
+    """
+    num_ticks = adcs.shape[0]
+    # Accumulate straight from the narrow ADC dtype; squares of 14-bit ADCs summed over a record overflow int32.
+    mean = adcs.sum(axis=0, dtype=np.int64) / num_ticks
+    mean_sq = np.einsum('ij,ij->j', adcs, adcs, dtype=np.int64) / num_ticks
+    return np.sqrt(np.maximum(mean_sq - mean**2, 0))
+
 def avg_rms_plot(adc, dt_title, run_id, num_events, savetype):
     """
     Plot the average RMS plot.
@@ -25,14 +63,14 @@ def avg_rms_plot(adc, dt_title, run_id, num_events, savetype):
     savename = f"avg-rms_run-{run_id}_{dt_title.strftime(DT_FORMAT)}.{savetype}"
     savepath = os.path.join(FIGURE_PATH, savename)
 
-    plt.figure()
-    plt.plot(adc, 'k')
-    plt.ylim((0,120))
-    plt.xlabel("Channels")
-    plt.ylabel("RMS")
-    plt.title(f"Run {run_id} Channel Average RMS: {num_events} Events\n{str(dt_title)}")
-    plt.savefig(savepath)
-    plt.close()
+    fig, ax = plt.subplots()
+    ax.plot(adc, 'k')
+    ax.set_ylim((0,120))
+    ax.set_xlabel("Channels")
+    ax.set_ylabel("RMS")
+    ax.set_title(f"Run {run_id} Channel Average RMS: {num_events} Events\n{str(dt_title)}")
+    fig.savefig(savepath)
+    plt.close(fig)
 
 def rms_plot(adc, dt_title, run_id, trig_id, savetype):
     """
@@ -41,14 +79,14 @@ def rms_plot(adc, dt_title, run_id, trig_id, savetype):
     savename = f"rms_run-{run_id}_TID{trig_id}_{dt_title.strftime(DT_FORMAT)}.{savetype}"
     savepath = os.path.join(FIGURE_PATH, savename)
 
-    plt.figure()
-    plt.plot(adc, 'k')
-    plt.ylim((0,120))
-    plt.xlabel("Channels")
-    plt.ylabel("RMS")
-    plt.title(f"Run {run_id} Channel RMS: Trigger ID {trig_id} \n{str(dt_title)}")
-    plt.savefig(savepath)
-    plt.close()
+    fig, ax = plt.subplots()
+    ax.plot(adc, 'k')
+    ax.set_ylim((0,120))
+    ax.set_xlabel("Channels")
+    ax.set_ylabel("RMS")
+    ax.set_title(f"Run {run_id} Channel RMS: Trigger ID {trig_id} \n{str(dt_title)}")
+    fig.savefig(savepath)
+    plt.close(fig)
 
 def parse():
     parser = argparse.ArgumentParser(description="Plot the channel RMS for an event.")
@@ -89,19 +127,20 @@ def main():
         adcs_rms = np.zeros((128,))
         num_records = len(records)
         mismatch = 0
-        for record in tqdm(records, total=num_records, desc="Record", disable=not do_tqdm):
-            try:
-                adcs = data.extract(record)
-                adcs_rms += np.std(adcs, axis=0)
-            except ValueError:
+        for _, adcs, error in tqdm(prefetch(data.extract, records), total=num_records, desc="Record", disable=not do_tqdm):
+            if isinstance(error, ValueError):
                 mismatch += 1
+                continue
+            if error is not None:
+                raise error
+            adcs_rms += channel_rms(adcs)
         adcs_rms /= (num_records - mismatch)
         avg_rms_plot(adcs_rms, run_time, run_id, num_records - mismatch, savetype)
         sys.exit(0)
     else:
         record = records[record_id]
         adcs = data.extract(record)
-        adcs_rms = np.std(adcs, axis=0)
+        adcs_rms = channel_rms(adcs)
         rms_plot(adcs_rms, run_time, run_id, record_id, savetype)
         sys.exit(0)
 
@@ -7,6 +7,8 @@ import argparse
 import datetime
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
 import matplotlib.pyplot as plt
 
 import fiftyl_toolkit
@@ -45,23 +47,39 @@ def plot(run_sum, wf, channel, record_id, run_time, run_id, savetype='svg', mini
     fig = plt.figure()
     ax1 = plt.gca()
 
-    ax1.plot(run_sum, color='k')
+    ax1.plot(run_sum, color='k', rasterized=True) # Thousands of ticks bloat a vector line.
     ax1.set_title(f"Run {run_id} Running Sum: Record {record_id} Channel {channel}\n{str(run_time)}")
     ax1.set_xlabel("Time ticks (512 ns / tick)")
     ax1.set_ylabel("ADC Count Sum")
 
     if mini_wf:
         ax2 = fig.add_axes([0.45, 0.4, 0.4, 0.4])
-        ax2.plot(wf, color='k')
+        ax2.plot(wf, color='k', rasterized=True)
         ax2.set_title("Waveform")
     plt.savefig(savepath)
     plt.close()
 
+def fast_median(adcs, axis):
+    """
+    Floored median of integer :adcs: along :axis: by partitioning instead of sorting.
+    Matches np.floor(np.median(adcs, axis=axis)) in the dtype of :adcs:.
+    """
+    num = adcs.shape[axis]
+    k = num // 2
+    if num % 2:
+        return np.partition(adcs, k, axis=axis).take(k, axis=axis)
+    part = np.partition(adcs, (k-1, k), axis=axis)
+    low = part.take(k-1, axis=axis).astype(np.int64)
+    return ((low + part.take(k, axis=axis)) // 2).astype(adcs.dtype)
+
 def median_subtraction(adcs):
     """
     Median subtract the ADCs.
+    The 14-bit ADCs fit in int16, so the result is an int16 copy subtracted in place.
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    wfs = adcs.astype(np.int16)
+    np.subtract(wfs, fast_median(wfs, 0), out=wfs)
+    return wfs
 
 def parse():
     parser = argparse.ArgumentParser(description="Generate the running sum for a given channel's waveform.")
@@ -108,12 +126,10 @@ def main():
 
     ### Processing & Plotting
     wf = data.extract(record, channel)
-    wf = median_subtraction(wf)
-    original_wf = wf.copy()
-    for idx in range(1,len(wf)):
-        wf[idx] = wf[idx] + wf[idx-1]
+    original_wf = median_subtraction(wf)
+    run_sum = np.cumsum(original_wf, axis=0, dtype=np.int64) # The running sum can overflow int16.
 
-    plot(wf, original_wf, channel, record_id, run_time, run_id, savetype, mini_wf)
+    plot(run_sum, original_wf, channel, record_id, run_time, run_id, savetype, mini_wf)
 
 if __name__ == "__main__":
     main()
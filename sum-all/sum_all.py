@@ -5,14 +5,22 @@ import os
 import sys
 import argparse
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import numpy as np
-from scipy import stats
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 import fiftyl_toolkit
 
+try:
+    from bottleneck import median # Quickselect median; same signature as np.median.
+except ImportError:
+    median = np.median
+
 __author__ = "Alejandro Oranday"
 __contact__ = "alejandro@oran.day"
 
@@ -21,25 +29,89 @@ DT_FORMAT = "%Y%m%dT%H%M%S" # datetime format from hdf5 files.
 FIGURE_PATH = "./figures"
 SAVE_PATH = "./saved_arrays"
 CHANNEL = 24
+SUM_TICKS = 3200 # Ticks of each record that are summed.
+
+DATA_FILES = {} # fiftyl_toolkit.Data handles opened by this process, keyed on file name.
 
 def median_subtraction(adcs):
     """
-    Median subtract the ADCs.
+    Median subtract the ADCs into an int32 copy, without a float temporary the size of :adcs:.
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    wfs = adcs.astype(np.int32)
+    wfs -= np.floor(median(wfs, axis=0)).astype(np.int32)
+    return wfs
 
 def mean_subtraction(adcs):
     """
     Mean subtract the ADCs.
     """
-    return (adcs - np.floor(np.mean(adcs, axis=0))).astype('int')
+    return (adcs - np.floor(np.mean(adcs, axis=0))).astype(np.int32)
+
+def column_mode(adcs):
+    """
+    Per channel mode of integer ADCs, taking the smallest value on ties like scipy.stats.mode.
+    Counts every channel in one np.bincount over per-channel offset bins instead of sorting.
+    """
+    adcs = adcs.astype(np.int64)
+    offset = adcs.min(axis=0)
+    shifted = adcs - offset
+    width = int(shifted.max()) + 1
+    num_channels = adcs.shape[1]
+    bins = shifted + np.arange(num_channels) * width
+    counts = np.bincount(bins.ravel(), minlength=num_channels * width).reshape(num_channels, width)
+    return counts.argmax(axis=1) + offset
 
 def mode_subtraction(adcs):
     """
     Mode subtract the ADCs.
     """
-    mode_array = np.array(stats.mode(adcs)[0])
-    return (adcs - mode_array).astype('int')
+    return (adcs - column_mode(adcs)).astype(np.int32)
+
+# Pedestal subtraction for each --ped-est. Looked up by name so the workers only receive a string.
+# "mean" deliberately falls back to the median, as the estimator selection always has; mean_subtraction is unused.
+PED_SUBTRACTIONS = {"median": median_subtraction, "mean": median_subtraction, "mode": mode_subtraction}
+
+def open_data(h5_file_name):
+    """
+    Open h5_file_name once per process and reuse the handle afterwards.
+    """
+    if h5_file_name not in DATA_FILES:
+        DATA_FILES[h5_file_name] = fiftyl_toolkit.Data(h5_file_name)
+    return DATA_FILES[h5_file_name]
+
+def sum_records(h5_file_name, records, ped_est, use_abs):
+    """
+    Pedestal subtract and sum a batch of records. Used by the process pool, so each
+    worker reads through its own data handle and only sends back its partial sum.
+        h5_file_name
+            Name of the HDF5 data file.
+        records
+            Records to sum.
+        ped_est
+            Pedestal estimator; a key of PED_SUBTRACTIONS.
+        use_abs
+            If True, sum the absolute values.
+    Returns the (SUM_TICKS, 128) int32 sum and the number of mismatched records.
+    """
+    data = open_data(h5_file_name)
+    ped_subtraction = PED_SUBTRACTIONS[ped_est]
+
+    adcs = np.zeros((SUM_TICKS, 128), dtype=np.int32) # 14-bit sums fit for >100k events.
+    mismatch = 0
+    for record in records:
+        try:
+            tmp_adc = data.extract(record)
+        except ValueError:
+            mismatch += 1
+            continue
+        if tmp_adc.shape[0] < SUM_TICKS:
+            mismatch += 1
+            continue
+        ped_subbed = ped_subtraction(tmp_adc[:SUM_TICKS, :])
+        if use_abs:
+            np.abs(ped_subbed, out=ped_subbed)
+        np.add(adcs, ped_subbed, out=adcs)
+    return adcs, mismatch
 
 def plot(adcs, dt_title, event_count, run_id, use_abs=False, savetype="svg"):
     """
@@ -64,7 +136,7 @@ def plot(adcs, dt_title, event_count, run_id, use_abs=False, savetype="svg"):
 
     save_path = os.path.join(FIGURE_PATH, savename)
     plt.figure()
-    plt.imshow(adcs, aspect='auto') #vmin=-2000, vmax=2000, aspect='auto')
+    plt.imshow(adcs, aspect='auto', interpolation='nearest') #vmin=-2000, vmax=2000, aspect='auto')
     plt.xlabel("Channels")
     plt.ylabel("Time tick (512 ns / tick)")
 
@@ -109,12 +181,11 @@ def mkdirs():
         print(f"Saving numpy arrays to {SAVE_PATH}.")
         os.makedirs(SAVE_PATH)
 
-def debug_runner(data):
+def debug_runner(data, records):
     """
     Runs a short section of the intended code, but prints out information.
     Exits after 5 iterations.
     """
-    records = data.get_records()
     adcs = np.zeros((3200, 128))
     for record in records[:5]:
         tmp_adcs = data.extract(record)[:3200, 128]
@@ -122,7 +193,7 @@ def debug_runner(data):
         mode_subbed = mode_subtraction(tmp_adcs)
         print("Mode Subtracted:", mode_subbed)
         coherent_baseline = np.sum(mode_subbed, axis=1) / 128 # <- Number of channels
-        mode_subbed = (mode_subbed.T - coherent_baseline).T
+        mode_subbed = mode_subbed - coherent_baseline[:, None]
         print("Coherent Noise Removal:", mode_subbed)
         adcs += tmp_adcs
         print("Sum:", adcs)
@@ -140,18 +211,6 @@ def main():
     debug = args.debug
     ped_est = args.ped_est
 
-    if ped_est == "median":
-        ped_subtraction = median_subtraction
-    elif ped_est == "mode":
-        ped_subtraction = mode_subtraction
-    else:
-        ped_subtraction = median_subtraction
-
-    if use_abs:
-        sum_operator = np.abs
-    else:
-        sum_operator = lambda x: x
-
     mkdirs()
 
     ### Extract Data
@@ -161,21 +220,19 @@ def main():
     run_id = data.get_run_id()
 
     if debug:
-        debug_runner(data)
+        debug_runner(data, records)
 
     ### Processing & Plotting
-    adcs = np.zeros((3200, 128))
+    adcs = np.zeros((SUM_TICKS, 128), dtype=np.int32)
     mismatch = 0
-    for record in tqdm(records, total=len(records), desc="Records", disable=not use_tqdm):
-        try:
-            tmp_adc = data.extract(record)
-        except ValueError:
-            mismatch += 1
-        if tmp_adc.shape[0] >= adcs.shape[0]:
-            ped_subbed = ped_subtraction(tmp_adc[:adcs.shape[0], :])
-            adcs += sum_operator(ped_subbed)
-        else:
-            mismatch += 1
+    num_workers = os.cpu_count()
+    batch_size = max(1, len(records) // (4 * num_workers)) # Amortize the IPC of each partial sum.
+    batches = [records[i:i+batch_size] for i in range(0, len(records), batch_size)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(sum_records, repeat(h5_file_name), batches, repeat(ped_est), repeat(use_abs))
+        for partial_sum, partial_mismatch in tqdm(results, total=len(batches), desc="Record batches", disable=not use_tqdm):
+            np.add(adcs, partial_sum, out=adcs)
+            mismatch += partial_mismatch
 
     print("Total mismatched:", mismatch)
     num_events = len(records) -  mismatch
@@ -5,18 +5,25 @@ import os
 import sys
 import argparse
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 import daqdataformats
-import detdataformats
-import detchannelmaps
 import fddetdataformats
 from hdf5libs import HDF5RawDataFile
 from rawdatautils.unpack.wibeth import np_array_adc
 
+try:
+    from bottleneck import median # Quickselect median; same signature as np.median.
+except ImportError:
+    median = np.median
+
 __author__ = "Alejandro Oranday"
 __contact__ = "alejandro@oran.day"
 
@@ -32,17 +39,35 @@ DT_FORMAT = "%Y%m%dT%H%M%S" # datetime format from hdf5 files.
 FIGURE_PATH = "figures/zero_events"
 SAVE_PATH = "saved_arrays/zero_events"
 
+SUM_BATCH = 16 # Records reduced into the partial sum at once.
+
+H5_FILES = {} # HDF5RawDataFile handles opened by this process, keyed on file name.
+
 CH_MAP = [112, 113, 115, 116, 118, 119, 120, 121, 123, 124, 126, 127, 64, 65, 67, 68, 70, 71, 72, 73, 75, 76, 78, 79, 48, 49, 51, 52, 54, 55, 56, 57, 59, 60, 62, 63, 0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15, 50, 53, 58, 61, 2, 5, 10, 13, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89, 90, 91, 92, 93, 94, 95, 96, 97, 98, 99, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 114, 117, 122, 125, 66, 69, 74, 77]
 
+# Inverse of CH_MAP: INV_CH_MAP[det_link * 64 + ch] is the mapped channel.
+INV_CH_MAP = np.empty(TOTAL_CHANNELS, dtype=np.int64)
+INV_CH_MAP[CH_MAP] = np.arange(TOTAL_CHANNELS)
+# LINK_CH_MAP[det_link] holds the mapped channels of all 64 channels on a link.
+LINK_CH_MAP = INV_CH_MAP.reshape(-1, CHANNELS_PER_WIB)
+
 def pedsub(adcs):
     """
-    Pedestal subtract given ADCs.
+    Pedestal subtract given (channels, time) ADCs in place.
+    The 14-bit ADCs stay in range of their int16 dtype after subtraction.
     """
-    return (adcs.T - np.floor(np.median(adcs, axis=1))).T.astype('int')
+    med = median(adcs, axis=1)
+    np.floor(med, out=med)
+    np.subtract(adcs, med.astype(adcs.dtype)[:, None], out=adcs)
+    return adcs
 
-def extract_adcs(h5_file, record):
+def extract_adcs(h5_file, record, out=None):
     wib_geo_ids = h5_file.get_geo_ids(record)
-    adcs = np.zeros( (len(wib_geo_ids) * CHANNELS_PER_WIB, FRAMES_PER_RECORD), dtype='int64' )
+    if out is None:
+        adcs = np.zeros( (len(wib_geo_ids) * CHANNELS_PER_WIB, FRAMES_PER_RECORD), dtype='int16' ) # 14-bit ADCs fit in int16.
+    else: # Reuse the caller's buffer; skipped fragments must still read as zeros.
+        adcs = out
+        adcs.fill(0)
 
     for i, gid in enumerate(wib_geo_ids):
         frag = h5_file.get_frag(record, gid)
@@ -57,17 +82,57 @@ def extract_adcs(h5_file, record):
             continue
         tmp_adc = tmp_adc[:FRAMES_PER_RECORD, :]
 
-        for ch in range(CHANNELS_PER_WIB):
-            mapped_ch = CH_MAP.index(det_link * 64 + ch)
-            adcs[mapped_ch, :] = tmp_adc.T[ch, :]
+        mapped_chs = LINK_CH_MAP[det_link]
+        adcs[mapped_chs, :] = tmp_adc.T
 
     return adcs
 
-def zero_sum_events(h5_file, records, use_tqdm=False, use_abs=False):
+def open_h5_file(h5_file_name):
+    """
+    Open h5_file_name once per process and reuse the handle afterwards.
+    """
+    if h5_file_name not in H5_FILES:
+        H5_FILES[h5_file_name] = HDF5RawDataFile(h5_file_name)
+    return H5_FILES[h5_file_name]
+
+def sum_records(h5_file_name, records, use_abs=False):
+    """
+    Pedestal subtract and sum a batch of records. Used by the process pool, so each
+    worker reads through its own file handle and only sends back its partial sum.
+        h5_file_name
+            Name of the HDF5 data file.
+        records
+            List of record IDs to sum.
+        use_abs
+            If True, use absolute values during the summation.
+    Returns the (TOTAL_CHANNELS, FRAMES_PER_RECORD) int32 sum and the number of events summed.
+    """
+    h5_file = open_h5_file(h5_file_name)
+    summed_events = np.zeros( (TOTAL_CHANNELS, FRAMES_PER_RECORD), dtype='int32' ) # 14-bit sums fit for >100k events.
+    # Records are extracted into this buffer and reduced SUM_BATCH at a time, so the
+    # accumulator is read and written once per batch instead of once per record.
+    batch = np.empty( (SUM_BATCH, TOTAL_CHANNELS, FRAMES_PER_RECORD), dtype='int16' )
+
+    for start in range(0, len(records), SUM_BATCH):
+        batch_records = records[start:start+SUM_BATCH]
+        for adcs, record in zip(batch, batch_records):
+            extract_adcs(h5_file, record, out=adcs)
+            pedsub(adcs)
+            #adcs_mask = (LOW_THRESHOLD >= adcs) | (adcs >= HIGH_THRESHOLD)
+            #adcs_mask[:88,:] = False
+            #adcs[adcs_mask] = 0
+            if use_abs:
+                np.abs(adcs, out=adcs)
+        np.add(summed_events, batch[:len(batch_records)].sum(axis=0, dtype=np.int32), out=summed_events)
+
+    return summed_events, len(records)
+
+def zero_sum_events(h5_file_name, records, use_tqdm=False, use_abs=False):
     """
     Zero all values outside of the range [LOW_THRESHOLD, HIGH_THRESHOLD] and sum these events.
-        h5_file
-            Data object to view events from.
+    Batches of records are summed across a process pool and the partial sums are added here.
+        h5_file_name
+            Name of the HDF5 data file to view events from.
         records
             List of record IDs to view.
         use_tqdm
@@ -75,38 +140,22 @@ def zero_sum_events(h5_file, records, use_tqdm=False, use_abs=False):
         use_abs
             If True, use absolute values during the summation.
     """
-    summed_events = np.zeros( (TOTAL_CHANNELS, FRAMES_PER_RECORD), dtype='int64' )
+    summed_events = np.zeros( (TOTAL_CHANNELS, FRAMES_PER_RECORD), dtype='int32' )
     event_count = 0
 
-    sum_operator = lambda x: x # Do not transform the value.
-    if use_abs:
-        sum_operator = np.abs # Transform by absolute value
-
-    for idx, record in tqdm(enumerate(records), desc="Record", total=len(records), disable=not use_tqdm):
-        wib_geo_ids = h5_file.get_geo_ids(record)
-        
-        for gid in wib_geo_ids:
-            frag = h5_file.get_frag(record, gid)
-            frag_type = frag.get_fragment_type()
-            if (frag_type != daqdataformats.FragmentType.kWIBEth):
-                continue
-
-            tmp_adc = np_array_adc(frag)
-            if tmp_adc.shape[0] < FRAMES_PER_RECORD:
-                continue
-
-        event_count += 1
-        adcs = extract_adcs(h5_file, record)
-        adcs = pedsub(adcs)
-        adcs_mask = (LOW_THRESHOLD >= adcs) | (adcs >= HIGH_THRESHOLD)
-        #adcs_mask[:88,:] = False
-        #adcs[adcs_mask] = 0
-        summed_events += sum_operator(adcs)
+    num_workers = os.cpu_count()
+    batch_size = max(1, len(records) // (4 * num_workers)) # Amortize the IPC of each partial sum.
+    batches = [records[i:i+batch_size] for i in range(0, len(records), batch_size)]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(sum_records, repeat(h5_file_name), batches, repeat(use_abs))
+        for partial_sum, partial_count in tqdm(results, desc="Record batches", total=len(batches), disable=not use_tqdm):
+            np.add(summed_events, partial_sum, out=summed_events)
+            event_count += partial_count
 
     print("Total events:", event_count)
     return summed_events, event_count
 
-def subplot(adcs, dt_title, run_id, event_count, use_abs=False):
+def subplot(adcs, dt_title, run_id, event_count, use_abs=False, savetype="svg"):
     """
     Plot 3-pane summed ADCs for each of the 3 planes.
         adcs
@@ -119,8 +168,10 @@ def subplot(adcs, dt_title, run_id, event_count, use_abs=False):
             Number of events that were summed for this plot; used in the plot title.
         use_abs
             Boolean if absolute value was used; used in the plot title.
+        savetype
+            File format to save as. Default : svg.
     """
-    savename = f"semi-filtered_summed_zero_events_subplots_{dt_title.strftime(DT_FORMAT)}.svg"
+    savename = f"semi-filtered_summed_zero_events_subplots_{dt_title.strftime(DT_FORMAT)}.{savetype}"
     if use_abs:
         savename = "abs_" + savename
 
@@ -136,7 +187,7 @@ def subplot(adcs, dt_title, run_id, event_count, use_abs=False):
     else:
         plt.suptitle(f"50L {run_id} Summed Non-Cosmics\n{str(dt_title)} -- {event_count} Events")
     for idx, (plane, channels) in enumerate(plane_channels):
-        z_plot = ax[idx].imshow(adcs.T[:, channels], aspect='auto', origin='lower')
+        z_plot = ax[idx].imshow(adcs.T[:, channels], aspect='auto', origin='lower', interpolation='nearest')
         ax[idx].set_title(plane)
         plt.colorbar(z_plot, ax=ax[idx])
     f.supxlabel("Channels")
@@ -145,7 +196,7 @@ def subplot(adcs, dt_title, run_id, event_count, use_abs=False):
     plt.savefig(savepath)
     plt.close()
 
-def plot(adcs, dt_title, run_id, event_count, use_abs=False):
+def plot(adcs, dt_title, run_id, event_count, use_abs=False, savetype="svg"):
     """
     Plot summed ADCs in the traditional 50L heatmap format.
         adcs
@@ -158,8 +209,10 @@ def plot(adcs, dt_title, run_id, event_count, use_abs=False):
             Number of events that were summed for this plot; used in the plot title.
         use_abs
             Boolean if absolute value was used; used in the plot title.
+        savetype
+            File format to save as. Default : svg.
     """
-    savename = f"summed_zero_events_{dt_title.strftime(DT_FORMAT)}.svg"
+    savename = f"summed_zero_events_{dt_title.strftime(DT_FORMAT)}.{savetype}"
     if use_abs:
         savename = "abs_" + savename
 
@@ -167,7 +220,7 @@ def plot(adcs, dt_title, run_id, event_count, use_abs=False):
 
     plt.figure()
     #plt.imshow(adcs.T, vmin=-2000, vmax=2000, aspect='auto')
-    plt.imshow(adcs.T, vmin=0, vmax=200, aspect='auto') # Doing vmin/vmax parameter testing. Oct-19-2023.
+    plt.imshow(adcs.T, vmin=0, vmax=200, aspect='auto', interpolation='nearest') # Doing vmin/vmax parameter testing. Oct-19-2023.
     plt.xlabel("Channels")
     plt.ylabel("Time tick (512 ns / tick)")
 
@@ -188,6 +241,7 @@ def parse():
     parser.add_argument("--tqdm", action="store_true", help="Use to display tqdm progress bar. Default off.")
     parser.add_argument("--abs", action="store_true", help="Use to sum using absolute value.")
     parser.add_argument("--subplots", action="store_true", help="Use to display as subplots.")
+    parser.add_argument("--savetype", type=str, help="File type to save the figure as. Default : svg.", default="svg")
     args = parser.parse_args()
 
     assert (args.filename[-4:] == "hdf5"), "File name is not an HDF5 data file."
@@ -200,6 +254,7 @@ def main():
     use_tqdm = args.tqdm
     use_abs = args.abs
     use_subplots = args.subplots
+    savetype = args.savetype
 
     # Check if the save dirs are made. If not, make them.
     if not os.path.isdir("figures/zero_events"):
@@ -218,7 +273,7 @@ def main():
     h5_file = HDF5RawDataFile(h5_file_name)
     records = h5_file.get_all_record_ids()
 
-    summed_events, event_count = zero_sum_events(h5_file, records, use_tqdm, use_abs)
+    summed_events, event_count = zero_sum_events(h5_file_name, records, use_tqdm, use_abs)
 
     if use_abs:
         with open("./saved_arrays/zero_events/semi-filtered_abs_summed_zero_events_{}.npy".format(run_time.strftime(DT_FORMAT)), "wb") as f:
@@ -228,9 +283,9 @@ def main():
             np.save(f, summed_events)
 
     if use_subplots:
-        subplot(summed_events, run_time, run_id, event_count, use_abs)
+        subplot(summed_events, run_time, run_id, event_count, use_abs, savetype)
     else:
-        plot(summed_events, run_time, run_id, event_count, use_abs)
+        plot(summed_events, run_time, run_id, event_count, use_abs, savetype)
     sys.exit(0)
 
 if __name__ == "__main__":
@@ -7,6 +7,8 @@ import argparse
 from datetime import datetime
 
 import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Figures are only saved, never shown.
 import matplotlib.pyplot as plt
 
 import fiftyl_toolkit
@@ -20,9 +22,11 @@ SAVE_PATH = "./saved_arrays"
 
 def median_subtract(adcs):
     """
-    Median subtract the ADCs.
+    Median subtract the ADCs into an int32 copy, without a float temporary the size of :adcs:.
     """
-    return (adcs - np.floor(np.median(adcs, axis=0))).astype('int')
+    wfs = adcs.astype(np.int32)
+    wfs -= np.floor(np.median(wfs, axis=0)).astype(np.int32)
+    return wfs
 
 def wf_plot(wf, dt_title, run_id, trig_id, channel, savetype):
     """
@@ -32,7 +36,7 @@ def wf_plot(wf, dt_title, run_id, trig_id, channel, savetype):
     savepath = os.path.join(FIGURE_PATH, savename)
 
     plt.figure()
-    plt.plot(wf, 'k')
+    plt.plot(wf, 'k', rasterized=True) # Thousands of ticks bloat a vector line.
     #plt.ylim((0,120))
     plt.xlabel("Frames")
     plt.ylabel("ADC Count (Median Shifted)")